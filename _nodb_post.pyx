@@ -0,0 +1,53 @@
+# Compiled versions of the tree walks in helper_classes.py, which uses these
+# when this module has been built (cythonize -i _nodb_post.pyx) and falls back
+# to its own pure Python versions otherwise. Keep the two in step.
+
+cdef inline void _visitSpecial(object node, object key, object value, list found, list stack):
+    if type(value) is dict:
+        if '_NoDBSpecialType' in <dict>value:
+            found.append((node, key, value))
+        else:
+            stack.append(value)
+    elif type(value) is list:
+        stack.append(value)
+
+def findSpecialTypes(object d):
+    cdef list found = []
+    cdef list stack = [d]
+    cdef object node, key, value
+    cdef Py_ssize_t i
+    while stack:
+        node = stack.pop()
+        if type(node) is dict:
+            for key, value in (<dict>node).items():
+                _visitSpecial(node, key, value, found, stack)
+        else:
+            for i in range(len(<list>node)):
+                _visitSpecial(node, i, (<list>node)[i], found, stack)
+    return found
+
+cdef inline object _copyValue(object value, frozenset json_types, dict dispatch, object default, list stack):
+    cdef type t = type(value)
+    if t is dict:
+        value = dict(<dict>value)
+        stack.append(value)
+    elif t is list or t is tuple:
+        value = list(value)
+        stack.append(value)
+    elif t not in json_types:
+        value = dispatch.get(t, default)(value)
+    return value
+
+def makeJSONSafe(object d, frozenset json_types, dict dispatch, object default):
+    cdef list stack = [d]
+    cdef object node, key
+    cdef Py_ssize_t i
+    while stack:
+        node = stack.pop()
+        if type(node) is dict:
+            for key in list((<dict>node).keys()):
+                (<dict>node)[key] = _copyValue((<dict>node)[key], json_types, dispatch, default, stack)
+        else:
+            for i in range(len(<list>node)):
+                (<list>node)[i] = _copyValue((<list>node)[i], json_types, dispatch, default, stack)
+    return d
@@ -1,54 +1,398 @@
+import collections
 import datetime
-import pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import base64
 import fcntl
+import mmap
 import os
 import errno
 import shutil
-import types
 import pprint
-import errors
+from . import errors
 import random
 import string
+import threading
+
+def _toBytes(s):
+    # Python 2's json modules already return ASCII bytes, and encoding them
+    # again would copy the whole document for nothing
+    if type(s) is bytes:
+        return s
+    return s.encode('utf-8')
 
 def getFastestJSONModule():
+    # The returned object's dumps() always produces bytes, so row files can be
+    # read and written in binary mode whichever backend ends up being used.
+    try:
+        module = __import__('orjson')
+        class json(object):
+            accepts_buffers = True # loads() can parse straight out of a memoryview
+            bounded_ints = True # only 64 bit integers, signed or unsigned
+            finite_floats_only = True # NaN and the infinities are written as null
+            loads = staticmethod(module.loads)
+            dumps = staticmethod(lambda obj: module.dumps(obj, option=module.OPT_NON_STR_KEYS))
+        return json()
+    except ImportError:
+        pass
+
+    try:
+        # msgspec can't turn the special type markers into objects while
+        # parsing, since rows have no fixed schema for it to decode against,
+        # but as a plain backend it's about as fast as orjson
+        module = __import__('msgspec').json
+        class json(object):
+            accepts_buffers = True
+            bounded_ints = False
+            finite_floats_only = True
+            loads = staticmethod(module.Decoder().decode)
+            dumps = staticmethod(module.Encoder().encode)
+        return json()
+    except ImportError:
+        pass
+
     try:
         module = __import__('ujson')
-        return module
+        class json(object):
+            accepts_buffers = False
+            bounded_ints = True
+            finite_floats_only = True
+            loads = staticmethod(module.loads)
+            dumps = staticmethod(lambda obj: _toBytes(module.dumps(obj)))
+        return json()
     except ImportError:
         pass
 
     try:
         module = __import__('cjson')
         class json(object):
-            loads = module.decode
-            dumps = module.encode
+            accepts_buffers = False
+            bounded_ints = True
+            finite_floats_only = True
+            loads = staticmethod(module.decode)
+            dumps = staticmethod(module.encode)
         return json()
     except ImportError:
         pass
 
     try:
         module = __import__('json')
-        return module
+        class json(object):
+            accepts_buffers = False
+            bounded_ints = False
+            finite_floats_only = False
+            loads = staticmethod(module.loads)
+            dumps = staticmethod(lambda obj: _toBytes(module.dumps(obj)))
+        return json()
     except ImportError:
         raise ImportError('No acceptable json module found.')
 
 json = getFastestJSONModule()
+# bound once here so the hot paths don't look them up on json every call
+_json_loads = json.loads
+_json_dumps = json.dumps
+
+_KEY_ALPHABET = string.ascii_letters + string.digits
+
+if hasattr(random, 'choices'): # Python 3.6+
+    def _randomKey(length):
+        return ''.join(random.choices(_KEY_ALPHABET, k=length))
+else:
+    def _randomKey(length):
+        choice = random.choice
+        return ''.join([choice(_KEY_ALPHABET) for i in range(length)])
+
+# rows smaller than this are read with a plain read(); below it, setting up a
+# mapping and faulting its pages in costs more than the copy it saves
+_MMAP_MIN_SIZE = 64 * 1024
+
+
+# datetimes are stored as whole microseconds since this naive epoch; counting
+# from a naive epoch rather than calling timestamp() keeps the stored value
+# free of the local timezone and its DST gaps, and an integer holds every
+# datetime exactly, from datetime.min to datetime.max
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+def _serializeDatetime(d):
+    if d.tzinfo is not None:
+        d = d.replace(tzinfo=None) # ctime() ignored tzinfo too
+    delta = d - _EPOCH
+    return {
+            '_NoDBSpecialType': 'datetime',
+            'value': (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds}
+
+# protocol 2 on Python 2; on Python 3 the newer protocols are several times
+# faster for sets, large buffers and the like, though Python 2 can't read them
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+def _serializePickled(d):
+    return {
+            '_NoDBSpecialType': 'pickled_object',
+            'value': base64.b64encode(pickle.dumps(d, _PICKLE_PROTOCOL)).decode('ascii')}
+
+def _decodePickle(value):
+    # Rows written before pickles were base64 encoded hold a protocol 0
+    # pickle, which always ends in the STOP opcode '.' -- a character that
+    # never appears in base64.
+    if value.endswith('.'):
+        return value.encode('latin-1')
+    return base64.b64decode(value)
+
+def _loadPickles(blobs):
+    # Protocol 4 and later number memo entries implicitly, in the order
+    # they're stored, so those pickles can't share a memo and are loaded one
+    # at a time.
+    first = blobs[0]
+    if len(blobs) == 1 or (first[:1] == b'\x80' and first[1:2] >= b'\x04'):
+        return [pickle.loads(blob) for blob in blobs]
+    # Older ones are unpickled with a single loads() call by splicing their
+    # bodies into one pickled list, saving the per-call unpickler setup.
+    # Each body only references memo entries it stored itself, so reusing
+    # memo slots across bodies is harmless. A row's pickles all come from
+    # the same save, so they share a protocol.
+    parts = [b'\x80\x02]('] # PROTO 2, EMPTY_LIST, MARK
+    for blob in blobs:
+        if blob[:1] == b'\x80':
+            blob = blob[2:] # drop the PROTO header...
+        parts.append(blob[:-1]) # ...and the STOP opcode
+    parts.append(b'e.') # APPENDS, STOP
+    return pickle.loads(b''.join(parts))
+
+# types JSON can hold as they are
+_JSON_TYPES = frozenset((str, int, float, bool, type(None)))
+try:
+    _JSON_TYPES |= frozenset((unicode, long)) # Python 2's other string and integer types
+except NameError:
+    pass
+
+# maps the exact type of any other non-container value to the function that
+# makes it JSON-safe; anything not listed here gets pickled
+_TYPE_DISPATCH = {
+        datetime.datetime: _serializeDatetime,
+        }
+
+def _serializeInt(d):
+    if -0x8000000000000000 <= d <= 0xffffffffffffffff:
+        return d
+    return _serializePickled(d)
+
+def _serializeFloat(d):
+    if d - d == 0.0: # only true for finite floats
+        return d
+    return _serializePickled(d)
+
+# The faster JSON backends can't hold every number: some fail on integers
+# beyond 64 bits, and some quietly write NaN and the infinities as null.
+# Checking every number up front would cost a call per leaf, so rows are
+# dumped with the types above first, and only walked again with these, which
+# pickle the numbers the backend can't hold, if dumping fails or writes null.
+_CHECKED_JSON_TYPES = _JSON_TYPES
+_CHECKED_TYPE_DISPATCH = dict(_TYPE_DISPATCH)
+if json.bounded_ints:
+    for t in (int, type(2 ** 64)): # the latter is long on Python 2
+        _CHECKED_JSON_TYPES -= frozenset((t,))
+        _CHECKED_TYPE_DISPATCH[t] = _serializeInt
+if json.finite_floats_only:
+    _CHECKED_JSON_TYPES -= frozenset((float,))
+    _CHECKED_TYPE_DISPATCH[float] = _serializeFloat
+
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+        'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+def _parseCtime(value):
+    # Parses the fixed-width output of datetime.ctime(), e.g.
+    # 'Wed Jun  9 04:26:40 1993', by slicing; strptime is many times slower
+    return datetime.datetime(int(value[20:24]), _MONTHS[value[4:7]], int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+def _loadDatetime(value, _EPOCH=_EPOCH, timedelta=datetime.timedelta):
+    # rows written before datetimes were stored as numbers hold a ctime() string
+    if isinstance(value, _STRING_TYPES):
+        return _parseCtime(value)
+    return _EPOCH + timedelta(microseconds=value)
+
+_SPECIAL_TYPE_LOADERS = {
+        'datetime': _loadDatetime,
+        }
+
+def _findSpecialTypes(d):
+    # Returns a (container, key, marker) triple for every special type marker
+    # in the parsed JSON d, walking it with an explicit stack rather than
+    # recursing.
+    _dict, _list, _type = dict, list, type
+    found = []
+    stack = [d]
+    while stack:
+        node = stack.pop()
+        pairs = node.items() if _type(node) is _dict else enumerate(node)
+        for key, value in pairs:
+            t = _type(value)
+            if t is _dict:
+                if '_NoDBSpecialType' in value:
+                    found.append((node, key, value))
+                else:
+                    stack.append(value)
+            elif t is _list:
+                stack.append(value)
+    return found
+
+def _makeJSONSafe(d, json_types, dispatch, default):
+    # Makes the values of d JSON-safe in place, keeping leaves whose type is in
+    # json_types and converting the rest with the function dispatch maps their
+    # exact type to, or with default. d must be a fresh dict or list owned by
+    # the caller: nested containers are copied before they're converted, so
+    # d is the only thing modified. Uses an explicit stack, not recursion.
+    _dict, _list, _tuple, _type = dict, list, tuple, type
+    stack = [d]
+    while stack:
+        node = stack.pop()
+        pairs = node.items() if _type(node) is _dict else enumerate(node)
+        for key, value in pairs:
+            t = _type(value)
+            if t in json_types: # most values are plain leaves, already in place in the copy
+                continue
+            if t is _dict:
+                value = _dict(value)
+                stack.append(value)
+            elif t is _list or t is _tuple:
+                value = _list(value)
+                stack.append(value)
+            else:
+                value = dispatch.get(t, default)(value)
+            node[key] = value
+    return d
+
+def _serializeAttribs(attribs, schema_encoder=None):
+    # attribs must be a fresh dict, since it's converted in place
+    safe = None
+    if schema_encoder is not None:
+        safe = schema_encoder(attribs)
+    if safe is None:
+        safe = _makeJSONSafe(attribs, _JSON_TYPES, _TYPE_DISPATCH, _serializePickled)
+    if _CHECKED_JSON_TYPES is _JSON_TYPES: # the backend holds any number
+        return _json_dumps(safe)
+
+    try:
+        contents = _json_dumps(safe)
+    except (TypeError, ValueError, OverflowError): # an integer too big for it
+        contents = None
+    if contents is None or (json.finite_floats_only and b'null' in contents):
+        safe = _makeJSONSafe(safe, _CHECKED_JSON_TYPES, _CHECKED_TYPE_DISPATCH, _serializePickled)
+        contents = _json_dumps(safe)
+    return contents
+
+def _compileSchemaEncoder(schema):
+    # Builds a function that makes rows JSON-safe in place when their
+    # attributes are exactly the names in schema, each of exactly the type it
+    # maps to. Each attribute gets its own generated statements, so there's no
+    # loop and no type dispatch per value. The function returns None for any
+    # row that doesn't match, which then goes through the generic walk.
+    names = sorted(schema)
+    namespace = {}
+    lines = [
+            'def encode(attribs):',
+            '    if len(attribs) != %d:' % len(names),
+            '        return None']
+    if names:
+        lines.append('    try:')
+        lines += ['        v%d = attribs[%r]' % (i, name) for i, name in enumerate(names)]
+        lines += [
+                '    except KeyError:',
+                '        return None']
+    checks = []
+    conversions = []
+    for i, name in enumerate(names):
+        t = namespace['t%d' % i] = schema[name]
+        checks.append('type(v%d) is not t%d' % (i, i))
+        if t in _JSON_TYPES:
+            continue
+        if t is dict or t is list or t is tuple:
+            # wrapped in a fresh list, so the walk copies the value rather
+            # than converting the caller's own container
+            conversions.append('    attribs[%r] = _makeJSONSafe([v%d], _JSON_TYPES, _TYPE_DISPATCH, _serializePickled)[0]' % (name, i))
+            namespace.update(_makeJSONSafe=_makeJSONSafe, _JSON_TYPES=_JSON_TYPES,
+                    _TYPE_DISPATCH=_TYPE_DISPATCH, _serializePickled=_serializePickled)
+        else:
+            namespace['c%d' % i] = _TYPE_DISPATCH.get(t, _serializePickled)
+            conversions.append('    attribs[%r] = c%d(v%d)' % (name, i, i))
+    if checks:
+        lines += [
+                '    if %s:' % ' or '.join(checks),
+                '        return None']
+    lines += conversions
+    lines.append('    return attribs')
+    exec('\n'.join(lines), namespace)
+    return namespace['encode']
+
+def _isFileAt(st, path):
+    # whether st, from fstat, describes the file now at path
+    try:
+        current = os.stat(path)
+    except OSError:
+        return False
+    return st.st_ino == current.st_ino and st.st_dev == current.st_dev
+
+def _writeAll(fd, data):
+    view = memoryview(data)
+    written = 0
+    while written < len(view): # normally done in a single write
+        written += os.write(fd, view[written:])
+
+# fdatasync skips flushing metadata such as timestamps, which isn't needed to
+# read the data back; not every platform has it
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+def _syncDir(path):
+    # makes renames and links into the directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+if hasattr(os, 'pread'): # Python 3.3+
+    def _readWhole(fd, size):
+        # one syscall, with no seek and no guessing at the size
+        return os.pread(fd.fileno(), size, 0)
+else:
+    def _readWhole(fd, size):
+        fd.seek(0)
+        return fd.read(size)
+
+# use the compiled versions of the walks above if _nodb_post.pyx has been built
+try:
+    from ._nodb_post import findSpecialTypes as _findSpecialTypes, makeJSONSafe as _makeJSONSafe
+except ImportError:
+    pass
+
+class LockState(object):
+    NONE = 0
+    SHARED = 1
+    EXCLUSIVE = 2
+
 
 class Lock(object):
     def __init__(self, fd):
         self._fd = fd
-        self.state = '' # can be 'shared', 'exclusive', 'saving', or '' (no lock)
+        self.state = LockState.NONE
 
     def acquireSharedLock(self):
         fcntl.flock(self._fd, fcntl.LOCK_SH)
-        self.state = 'shared'
+        self.state = LockState.SHARED
 
     def acquireExclusiveLock(self):
         fcntl.flock(self._fd, fcntl.LOCK_EX)
-        self.state = 'exclusive'
+        self.state = LockState.EXCLUSIVE
 
     def releaseLock(self):
-        self.state = ''
+        self.state = LockState.NONE
         fcntl.flock(self._fd, fcntl.LOCK_UN)
 
     def getExclusiveLockWrapper(self):
@@ -80,14 +424,111 @@ class SharedLockWrapper(object):
         self._lock.releaseLock()
 
 
+class FilePool(object):
+    # Keeps the files of recently closed rows open, so getting the same row
+    # again doesn't have to reopen it. A file is only handed to one Row at a
+    # time, since flock locks belong to the open file rather than to the Row.
+    # A Table and its pool may be shared between threads, so the pool's dict
+    # is only touched while holding _mutex.
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._files = collections.OrderedDict()
+        self._mutex = threading.Lock()
+        self._closed = False # set by clear(), once the Table is closed
+
+    def checkOut(self, key, filename):
+        with self._mutex:
+            fd = self._files.pop(key, None)
+        if fd is not None:
+            st = os.fstat(fd.fileno())
+            # the row hasn't been replaced by a save or removed; see Row._isCurrentFile
+            if st.st_nlink == 1 or _isFileAt(st, filename):
+                return fd
+            fd.close()
+        return open(filename, 'rb')
+
+    def checkIn(self, key, fd):
+        evicted = None
+        with self._mutex:
+            if self._closed or key in self._files or self._maxsize <= 0:
+                evicted = fd
+            else:
+                self._files[key] = fd
+                if len(self._files) > self._maxsize:
+                    evicted = self._files.popitem(last=False)[1]
+        if evicted is not None:
+            evicted.close()
+
+    def discard(self, key):
+        with self._mutex:
+            fd = self._files.pop(key, None)
+        if fd is not None:
+            fd.close()
+
+    def clear(self):
+        # Rows still open keep their files, and close them on checkIn
+        with self._mutex:
+            self._closed = True
+            files = list(self._files.values())
+            self._files.clear()
+        for fd in files:
+            fd.close()
+
+
+class RowCache(object):
+    # Keeps the contents of recently read rows that hold special types, keyed
+    # on the identity of the file they came from so a save by anyone makes
+    # the entry stale. Contents are stored pickled, which hands every Row its
+    # own copy to modify. For a plain JSON row, unpickling costs about as much
+    # as parsing it again, so Row only caches rows whose special types would
+    # otherwise have to be found and converted.
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._rows = collections.OrderedDict()
+        self._mutex = threading.Lock() # as in FilePool
+
+    def get(self, key, stamp):
+        with self._mutex:
+            entry = self._rows.pop(key, None)
+            if entry is None or entry[0] != stamp:
+                return None
+            self._rows[key] = entry
+        return pickle.loads(entry[1])
+
+    def put(self, key, stamp, contents):
+        if self._maxsize <= 0:
+            return
+        try:
+            blob = pickle.dumps(contents, _PICKLE_PROTOCOL)
+        except (pickle.PicklingError, TypeError): # an unpickled object that can't be pickled again
+            self.discard(key)
+            return
+        with self._mutex:
+            self._rows.pop(key, None)
+            self._rows[key] = (stamp, blob)
+            if len(self._rows) > self._maxsize:
+                self._rows.popitem(last=False)
+
+    def discard(self, key):
+        with self._mutex:
+            self._rows.pop(key, None)
+
+
 class NoDBBase(object):
     def __init__(self, fd_lock):
         self._fd_lock = fd_lock
         self._lock = Lock(self._fd_lock)
 
-    def __del__(self):
-        self.releaseLock()
-        self._fd_lock.close()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if not self._fd_lock.closed:
+            self.releaseLock()
+            self._fd_lock.close()
 
     def acquireSharedLock(self):
         self._lock.acquireSharedLock()
@@ -98,24 +539,51 @@ class NoDBBase(object):
     def releaseLock(self):
         self._lock.releaseLock()
 
-    def getLockState(self):
+    def getLockState(self): # one of the LockState values
         return self._lock.state
 
 
+class Manager(object):
+    def __init__(self, data_dir):
+        self._data_dir = data_dir
+
+    def getDatabase(self, db):
+        return Database(self._data_dir, db)
+
+    def createDatabase(self, db):
+        try:
+            os.mkdir(self._data_dir + os.sep + db)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise errors.DatabaseAlreadyExists(db)
+            else:
+                raise
+
+    def removeDatabase(self, db):
+        try:
+            shutil.rmtree(self._data_dir + os.sep + db)
+        except OSError as e:
+            if e.errno == errno.ENOENT: # if the database doesn't exist
+                raise errors.DatabaseDoesNotExist(db)
+            else:
+                raise
+
+
 class Database(NoDBBase):
     def __init__(self, data_dir, db):
         self._data_dir = data_dir
         self._db = db
+        self._db_dir = os.path.join(self._data_dir, self._db)
 
-        fd_lock = open(os.path.join(self._data_dir, self._db, '.lock'), 'w')
+        fd_lock = open(self._db_dir + os.sep + '.lock', 'w')
         super(Database, self).__init__(fd_lock)
 
-    def getTable(self, table):
-        return Table(self._data_dir, self._db, table)
+    def getTable(self, table, sync=False):
+        return Table(self._data_dir, self._db, table, sync=sync)
 
     def createTable(self, table):
         try:
-            os.mkdir(os.path.join(self._data_dir, self._db, table))
+            os.mkdir(self._db_dir + os.sep + table)
         except OSError as e:
             if e.errno == errno.EEXIST:
                 raise errors.TableAlreadyExists(table)
@@ -124,8 +592,8 @@ class Database(NoDBBase):
 
     def removeTable(self, table):
         try:
-            shutil.rmtree(os.path.join(self._data_dir, self._db, table))
-        except OSError:
+            shutil.rmtree(self._db_dir + os.sep + table)
+        except OSError as e:
             if e.errno == errno.ENOENT: # if the table doesn't exist
                 raise errors.TableDoesNotExist(table)
             else:
@@ -133,28 +601,116 @@ class Database(NoDBBase):
 
 
 class Table(NoDBBase):
-    def __init__(self, data_dir, db, table):
+    def __init__(self, data_dir, db, table, file_pool_size=128, cache_size=1024, sync=False):
         self._data_dir = data_dir
         self._db = db
         self._table = table
+        self._table_dir = os.path.join(self._data_dir, self._db, self._table)
+        self._sync = sync # flush rows to disk before save() and createRow() return
 
-        fd_lock = open(os.path.join(self._data_dir, self._db, self._table, '.lock'), 'w')
+        self._file_pool = FilePool(file_pool_size)
+        self._row_cache = RowCache(cache_size)
+        self._schema_encoder = None
+
+        fd_lock = open(self._table_dir + os.sep + '.lock', 'w')
         super(Table, self).__init__(fd_lock)
 
+    def close(self):
+        self._file_pool.clear()
+        super(Table, self).close()
+
+    def setSchema(self, schema):
+        # schema maps the attribute names most rows of this table have to the
+        # type of each one, e.g. {'name': str, 'created': datetime.datetime}.
+        # Rows with exactly those attributes and types are then saved by an
+        # encoder generated for them; any other row is saved as usual. Only
+        # rows got from this table after the call use it. None removes it.
+        if schema is None:
+            self._schema_encoder = None
+        else:
+            self._schema_encoder = _compileSchemaEncoder(schema)
+
     def getRow(self, key, lock_type=None):
-        row = Row(self._data_dir, self._db, self._table, key, lock_type)
+        row = Row(self._table_dir, key, lock_type, self._file_pool, self._row_cache, self._sync, self._schema_encoder)
         return row
 
     def createRow(self, key, lock_type=None): # lock can be 'shared' or 'exclusive'
-        with self._lock.getExclusiveLockWrapper():
-            filename = os.path.join(self._data_dir, self._db, self._table, key)
-            if os.path.exists(filename):
+        return self.createRows({key: {}}, lock_type)[key]
+
+    def createRows(self, rows, lock_type=None):
+        # Creates a row for each key in rows, holding the attributes the key
+        # maps to, and returns the new Row objects by key. If a key already
+        # exists RowAlreadyExists is raised, and rows created before it stay.
+        contents = {}
+        for key, attribs in rows.items():
+            attribs = dict((name, value) for name, value in attribs.items() if not name.startswith('_'))
+            if attribs:
+                contents[key] = _serializeAttribs(attribs, self._schema_encoder)
+
+        created = {}
+        for key in rows:
+            filename = self._table_dir + os.sep + key
+            if key in contents:
+                self._linkNewRow(key, filename, contents[key])
+            else:
+                self._createEmptyRow(key, filename)
+            created[key] = Row(self._table_dir, key, lock_type, self._file_pool, self._row_cache, self._sync, self._schema_encoder)
+        if self._sync: # one directory sync covers every row created
+            _syncDir(self._table_dir)
+        return created
+
+    def _createEmptyRow(self, key, filename):
+        # O_EXCL makes creating the file fail if the row exists, so there's no
+        # need to hold the table lock between checking and creating. Readers
+        # take a file that's still empty to be an empty row.
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
                 raise errors.RowAlreadyExists(key)
-            with open(filename, 'w') as fd:
-                fd.write('{}') # touch the file so we can lock it later, and fill it with an empty JSON dict
-            row = Row(self._data_dir, self._db, self._table, key, lock_type)
+            else:
+                raise
+        try:
+            os.write(fd, b'{}') # fill the file with an empty JSON dict
+            if self._sync:
+                _fdatasync(fd)
+        finally:
+            os.close(fd)
 
-        return row
+    def _linkNewRow(self, key, filename, contents):
+        # Rows created with contents are written to a temporary file that's
+        # then hard linked into place, so they never appear half written. Like
+        # O_EXCL, the link fails if the row already exists.
+        tmp_filename = '%s%s.%s.%d.%d.new' % (self._table_dir, os.sep, key, os.getpid(), threading.current_thread().ident)
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            try:
+                _writeAll(fd, contents)
+                if self._sync:
+                    _fdatasync(fd)
+            finally:
+                os.close(fd)
+            os.link(tmp_filename, filename)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise errors.RowAlreadyExists(key)
+            else:
+                raise
+        finally:
+            try:
+                os.remove(tmp_filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT: # a save may have removed it, see Row._removeStrayLinks
+                    raise
+
+    def saveRows(self, rows):
+        # Serializes every row before taking any row locks, so each lock is
+        # only held for the file write itself.
+        contents = [row._serialize() for row in rows]
+        for row, row_contents in zip(rows, contents):
+            row._saveContents(row_contents, sync_dir=False)
+        if self._sync: # one directory sync covers every row's rename
+            _syncDir(self._table_dir)
 
     def createRowWithUniqueKey(self, key_len=5, lock_type=None):
         while True:
@@ -168,26 +724,31 @@ class Table(NoDBBase):
         return row
 
     def remove(self, key):
+        self._file_pool.discard(key)
+        self._row_cache.discard(key)
         try:
-            os.remove(os.path.join(self._data_dir, self._db, self._table, key))
-        except IOError as e:
+            os.remove(self._table_dir + os.sep + key)
+        except OSError as e:
             if e.errno == errno.ENOENT: # if the file doesn't exist
                 raise errors.RowDoesNotExist(key)
             else:
                 raise
 
     def _generateRandomString(self, length=5):
-        return ''.join([random.choice(string.ascii_letters + string.digits) for i in range(length)])
+        return _randomKey(length)
 
 
 class Row(NoDBBase):
-    def __init__(self, data_dir, db, table, key, lock_type=None):
-        self._data_dir = data_dir
-        self._db = db
-        self._table = table
+    def __init__(self, table_dir, key, lock_type=None, file_pool=None, row_cache=None, sync=False, schema_encoder=None):
+        self._table_dir = table_dir
         self._key = key
-        self._filename = os.path.join(self._data_dir, self._db, self._table, key)
-        self._fd_readonly = open(self._filename, 'r')
+        self._filename = self._table_dir + os.sep + key
+        self._file_pool = file_pool
+        self._row_cache = row_cache
+        self._sync = sync
+        self._schema_encoder = schema_encoder
+        self._loaded = False
+        self._fd_readonly = self._openFile()
         super(Row, self).__init__(self._fd_readonly)
 
         if lock_type == 'shared':
@@ -195,95 +756,277 @@ class Row(NoDBBase):
         elif lock_type == 'exclusive':
             self.acquireExclusiveLock()
 
+        # the contents are read on first use, see __getattr__
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails, which for a public name means
+        # the contents haven't been read yet, or the row doesn't have it
+        if name[0] == '_' or self.__dict__.get('_loaded', True):
+            raise AttributeError(name)
         self._loadContents()
+        return getattr(self, name)
 
-    def _loadContents(self):
-        self._fd_readonly.seek(0)
-        if self.getLockState() == '':
-            self.acquireSharedLock()
-            contents = self._fd_readonly.read()
+    def __delattr__(self, name):
+        if name[0] != '_' and not self._loaded:
+            self._loadContents()
+        super(Row, self).__delattr__(name)
+
+    def _openFile(self):
+        if self._file_pool is None:
+            return open(self._filename, 'rb')
+        return self._file_pool.checkOut(self._key, self._filename)
+
+    def close(self):
+        if self._file_pool is None:
+            super(Row, self).close()
+        elif self._fd_readonly is not None:
             self.releaseLock()
-        else:
-            contents = self._fd_readonly.read()
-        contents = self._desearialize(contents)
+            self._file_pool.checkIn(self._key, self._fd_readonly)
+            self._fd_readonly = self._fd_lock = None
+            # the file may now belong to another Row, so it mustn't be locked
+            # through this one; _ensureOpen() gives it a new lock
+            self._lock = Lock(None)
+
+    def _ensureOpen(self):
+        # Locking or saving a closed row opens its file again, so close() it
+        # again when done
+        if self._fd_readonly is None or self._fd_readonly.closed:
+            self._fd_readonly = self._fd_lock = self._openFile()
+            self._lock = Lock(self._fd_readonly)
+
+    def acquireSharedLock(self):
+        self._ensureOpen()
+        while True:
+            super(Row, self).acquireSharedLock()
+            if self._isCurrentFile():
+                return
+            self.releaseLock()
+            self._reopen()
+
+    def acquireExclusiveLock(self):
+        self._ensureOpen()
+        while True:
+            super(Row, self).acquireExclusiveLock()
+            if self._isCurrentFile():
+                return
+            self.releaseLock()
+            self._reopen()
+
+    def _isCurrentFile(self):
+        # save() replaces the row file rather than rewriting it, so the file we
+        # have open may have been swapped out since we opened it. A file with
+        # exactly one link is the row file itself, which saves an os.stat: a
+        # crash while creating a row can leave a temporary file linked to it
+        # too, but saves remove such links before replacing the file. With any
+        # other link count we compare inodes.
+        st = os.fstat(self._fd_readonly.fileno())
+        if st.st_nlink == 1:
+            return True
+        try:
+            current = os.stat(self._filename)
+        except OSError as e:
+            if e.errno == errno.ENOENT: # the row was removed, so there's nothing newer
+                return True
+            raise
+        return st.st_ino == current.st_ino and st.st_dev == current.st_dev
+
+    def _reopen(self):
+        self._swapFile(open(self._filename, 'rb'), None)
+
+    def _swapFile(self, fd, lock):
+        old_fd = self._fd_readonly
+        self._fd_readonly = self._fd_lock = fd
+        self._lock = lock or Lock(fd)
+        old_fd.close()
+
+    def _loadContents(self):
+        # Reading doesn't need a lock: save() swaps in the complete new file
+        # with a single rename, so whichever file we read is never half
+        # written. We only have to make sure it's still the current one.
+        closed = self._fd_readonly is None or self._fd_readonly.closed
+        if closed: # the row was closed before its contents were needed
+            self._fd_readonly = open(self._filename, 'rb')
+        elif self._lock.state == LockState.NONE and not self._isCurrentFile():
+            self._reopen()
+        try:
+            contents = self._readContents()
+        finally:
+            if closed:
+                self._fd_readonly.close()
+                self._fd_readonly = self._fd_lock
+        if not self._loaded: # attributes set before the first load win
+            contents.update(self._getPublicAttribs())
+            self._loaded = True
         self.__dict__.update(contents)
 
+    def _readContents(self):
+        fileno = self._fd_readonly.fileno()
+        st = os.fstat(fileno)
+        if self._row_cache is None:
+            return self._parseContents(fileno, st.st_size)[0]
+
+        stamp = (st.st_ino, st.st_dev, st.st_mtime, st.st_size)
+        contents = self._row_cache.get(self._key, stamp)
+        if contents is None:
+            contents, has_special_types = self._parseContents(fileno, st.st_size)
+            if has_special_types:
+                self._row_cache.put(self._key, stamp, contents)
+        return contents
+
+    def _parseContents(self, fileno, size):
+        # Large rows are parsed straight out of a read-only mapping of the file
+        # when the JSON module can take a buffer, instead of being copied into
+        # a string first. Returns the contents and whether they held any
+        # special types.
+        if size == 0: # a row just created empty, before its '{}' is written
+            return {}, False
+        if not json.accepts_buffers or size < _MMAP_MIN_SIZE:
+            contents = _readWhole(self._fd_readonly, size)
+            has_special_types = b'_NoDBSpecialType' in contents
+            return self._desearialize(contents, has_special_types), has_special_types
+
+        mm = mmap.mmap(fileno, 0, prot=mmap.PROT_READ)
+        try:
+            if hasattr(mm, 'madvise'): # Python 3.8+
+                mm.madvise(mmap.MADV_WILLNEED)
+            has_special_types = mm.find(b'_NoDBSpecialType') != -1
+            view = memoryview(mm)
+            try:
+                return self._desearialize(view, has_special_types), has_special_types
+            finally:
+                view.release()
+        finally:
+            mm.close()
+
     def __repr__(self):
+        if not self._loaded:
+            self._loadContents()
         attribs = self._getPublicAttribs()
         return '<NoDB.Row object - key: %s>\n\n%s' % (self._key, pprint.pformat(attribs))
 
     def _getPublicAttribs(self):
-        return dict([(key, value) for key, value in self.__dict__.items() if key[0] != '_'])
+        return {key: value for key, value in self.__dict__.items() if key[0] != '_'}
 
     def _desearializeHelper(self, d):
-        if type(d) in (list, tuple):
-            return map(self._desearializeHelper, d)
-        elif type(d) == dict:
-            if d.has_key('_NoDBSpecialType'):
-                if d['_NoDBSpecialType'] == 'datetime':
-                    return datetime.datetime.strptime(d['value'], '%a %b %d %H:%M:%S %Y')
-                elif d['_NoDBSpecialType'] == 'pickled_object':
-                    return pickle.loads(str(d['value']))
-            else:
-                for key in d:
-                    d[key] = self._desearializeHelper(d[key])
-                return d
-        else:
-            return d
+        # Replaces special type markers in place. Pickled objects are collected
+        # and unpickled together once all the markers have been found.
+        loaders = _SPECIAL_TYPE_LOADERS
+        pickled = []
+        root = [d]
+        for node, key, marker in _findSpecialTypes(root):
+            special_type = marker['_NoDBSpecialType']
+            if special_type == 'pickled_object':
+                pickled.append((node, key, _decodePickle(marker['value'])))
+            elif special_type in loaders:
+                node[key] = loaders[special_type](marker['value'])
 
-    def _desearialize(self, contents):
-        contents = json.loads(contents)
-        contents = self._desearializeHelper(contents)
+        if pickled:
+            objs = _loadPickles([blob for node, key, blob in pickled])
+            for (node, key, blob), obj in zip(pickled, objs):
+                node[key] = obj
+        return root[0]
+
+    def _desearialize(self, contents, has_special_types=True):
+        # Most rows hold no special types, and a substring search of the raw
+        # JSON is far cheaper than walking the parsed result to find that out
+        contents = _json_loads(contents)
+        if has_special_types:
+            contents = self._desearializeHelper(contents)
         return contents
 
     def getCreated(self):
-        return datetime.datetime.fromtimestamp(os.path.getctime(self._filename))
+        return datetime.datetime.fromtimestamp(self._stat().st_ctime)
 
     def getModified(self):
-        return datetime.datetime.fromtimestamp(os.path.getmtime(self._filename))
+        return datetime.datetime.fromtimestamp(self._stat().st_mtime)
+
+    def _stat(self):
+        # fstat on the open file skips the path lookup that os.stat does; the
+        # path is only needed once a save has replaced the file we have open,
+        # or once the row is closed
+        if self._fd_readonly is None or self._fd_readonly.closed:
+            return os.stat(self._filename)
+        st = os.fstat(self._fd_readonly.fileno())
+        if st.st_nlink == 1: # see _isCurrentFile
+            return st
+        return os.stat(self._filename)
 
     def getKey(self):
         return self._key
 
     def save(self):
-        if self.getLockState() == '':
+        # serializing only reads our own attributes, so it's done before
+        # taking the lock rather than while holding it
+        self._saveContents(self._serialize())
+
+    def _saveContents(self, contents, sync_dir=True):
+        state = self._lock.state
+        if state == LockState.NONE:
             self.acquireExclusiveLock()
-            self._writeContents()
+            self._writeContents(contents, sync_dir)
             self.releaseLock()
-        elif self.getLockState() == 'shared':
+        elif state == LockState.SHARED:
             self.acquireExclusiveLock()
-            self._writeContents()
+            self._writeContents(contents, sync_dir)
+            # flock converts the exclusive lock we hold on the new file to a
+            # shared one directly, without unlocking first
             self.acquireSharedLock()
-        elif self.getLockState() == 'exclusive':
-            self._writeContents()
+        elif state == LockState.EXCLUSIVE:
+            self._writeContents(contents, sync_dir)
         else:
             raise RuntimeError('Invalid lock type.')
 
-    def _writeContents(self):
-        attribs = self._serialize()
-        with open(self._filename, 'w') as fd:
-            fd.write(attribs)
-
-    def _serializeHelper(self, d):
-        if type(d) in (list, tuple):
-            return map(self._serializeHelper, d)
-        elif type(d) == dict:
-            for key in d:
-                d[key] = self._serializeHelper(d[key])
-            return d
-        elif type(d) == datetime.datetime:
-            return {
-                    '_NoDBSpecialType': 'datetime',
-                    'value': d.ctime()}
-        elif type(d) in (dict, list, tuple, str, unicode, int, long, float, bool, types.NoneType): # json-supported data types
-            return d
-        else:
-            return {
-                    '_NoDBSpecialType': 'pickled_object',
-                    'value': pickle.dumps(d)}
+    def _writeContents(self, contents, sync_dir=True):
+        # The contents go to a temporary file which then replaces the row file,
+        # so nobody ever sees it half written. The new file is locked before
+        # the rename, so our exclusive lock carries over to it; anyone waiting
+        # on the old file sees that it was replaced once they get the lock.
+        # When syncing, the data is flushed before the rename so a crash can't
+        # leave the row replaced by an empty file, and the directory after it.
+        tmp_filename = '%s%s.%s.%d.tmp' % (self._table_dir, os.sep, self._key, os.getpid())
+        fd = os.open(tmp_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            _writeAll(fd, contents)
+            if self._sync:
+                _fdatasync(fd)
+            new_fd = os.fdopen(fd, 'rb')
+        except:
+            os.close(fd)
+            os.remove(tmp_filename)
+            raise
+
+        st = os.fstat(self._fd_readonly.fileno())
+        if st.st_nlink > 1:
+            self._removeStrayLinks(st)
+
+        lock = Lock(new_fd)
+        lock.acquireExclusiveLock()
+        os.rename(tmp_filename, self._filename)
+        if self._sync and sync_dir:
+            _syncDir(self._table_dir)
+        self._swapFile(new_fd, lock)
+        if self._row_cache is not None:
+            self._row_cache.discard(self._key)
+
+    def _removeStrayLinks(self, st):
+        # A crash between Table._linkNewRow linking a new row into place and
+        # removing its temporary file leaves that file as a second link to the
+        # row. Once a save replaced the row, the old file would still have one
+        # link, which _isCurrentFile takes to mean it's current, so the links
+        # are removed before the row file is replaced.
+        prefix = '.%s.' % self._key
+        for name in os.listdir(self._table_dir):
+            if not (name.startswith(prefix) and name.endswith('.new')):
+                continue
+            path = self._table_dir + os.sep + name
+            if _isFileAt(st, path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT: # its creator got there first
+                        raise
 
     def _serialize(self):
-        attribs = self._getPublicAttribs()
-        attribs = self._serializeHelper(attribs)
-        attribs = json.dumps(attribs)
-        return attribs
+        if not self._loaded: # saving must keep the attributes we never read
+            self._loadContents()
+        return _serializeAttribs(self._getPublicAttribs(), self._schema_encoder)